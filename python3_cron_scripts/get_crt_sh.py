@@ -19,13 +19,18 @@ out the requests against their service.
 
 Whether the certificates are saved to disk is optional. This script will create the directory for
 saving certificates. The default is "/mnt/workspace/crt_sh" but this can be overridden.
+Saved certificates are spread across two levels of subfolders based on their crt.sh ID
+(e.g. "40/e2/123456.crt") so that no single folder grows too large.
 """
 
 import argparse
-import json
+import atexit
 import logging
 import os
+import signal
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 
 import requests
@@ -39,8 +44,110 @@ from libs3 import (
 )
 from libs3.LoggingUtil import LoggingUtil
 from libs3.ZoneManager import ZoneManager
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 from requests.adapters import HTTPAdapter
-from urllib3.util import Retry
+from urllib3.util import Retry, make_headers
+
+# orjson is considerably faster than the standard library when parsing the large crt.sh responses.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# The maximum number of certificate downloads per second that are sent to crt.sh across all threads
+CRT_SH_REQUESTS_PER_SECOND = 2
+
+# The maximum number of zone queries per second that are sent to crt.sh (one every five seconds)
+CRT_SH_ZONE_REQUESTS_PER_SECOND = 0.2
+
+# The number of concurrent certificate downloads against crt.sh
+CRT_SH_WORKERS = 8
+
+# The number of concurrent zone queries against crt.sh
+CRT_SH_ZONE_WORKERS = 4
+
+# The number of concurrent Google DNS lookups. DNS over HTTPS throughput levels off
+# beyond this point so additional threads only add load.
+DNS_LOOKUP_WORKERS = 16
+
+# The number of certificate writes that are sent to MongoDB in a single bulk_write
+MONGO_BATCH_SIZE = 500
+
+# The number of DNS records that are sent to MongoDB in a single bulk write
+DNS_BATCH_SIZE = 1000
+
+# Certificate fields that are managed by the $set and $addToSet of an upsert
+UPSERT_EXCLUDED_FIELDS = [
+    "fingerprint_sha256",
+    "crt_sh_min_id",
+    "zones",
+    "marinus_updated",
+    "sources",
+]
+
+
+class RateLimiter(object):
+    """
+    A thread safe token bucket that limits the rate of requests across all of the worker threads.
+    A caller only sleeps when the bucket is empty rather than sleeping before every request.
+    """
+
+    def __init__(self, rate):
+        """
+        Initialize the bucket with the maximum number of requests per second.
+        """
+        self.rate = rate
+        # The bucket holds at least one token so that rates below one per second still work
+        self.capacity = max(rate, 1)
+        self.allowance = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request is allowed under the rate limit.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.allowance = min(
+                self.capacity, self.allowance + (now - self.last) * self.rate
+            )
+            self.last = now
+
+            if self.allowance < 1:
+                time.sleep((1 - self.allowance) / self.rate)
+                self.last = time.monotonic()
+                self.allowance = 0
+            else:
+                self.allowance -= 1
+
+
+class RateLimitedRetry(Retry):
+    """
+    A urllib3 Retry that also waits on a RateLimiter before each retry attempt.
+    Otherwise, the retries performed inside the session would bypass the rate limit.
+    """
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    def new(self, **kwargs):
+        """
+        urllib3 creates a new Retry object for each attempt so the limiter is carried over.
+        """
+        retry = super().new(**kwargs)
+        retry.limiter = self.limiter
+        return retry
+
+    def sleep(self, response=None):
+        """
+        Apply the normal backoff and then wait for the rate limit.
+        """
+        super().sleep(response)
+        if self.limiter is not None:
+            self.limiter.acquire()
 
 
 def requests_retry_session(
@@ -48,31 +155,55 @@ def requests_retry_session(
     backoff_factor=7,
     status_forcelist=[408, 500, 502, 503, 504],
     session=None,
+    limiter=None,
 ):
     session = session or requests.Session()
-    retry = Retry(
+    retry = RateLimitedRetry(
         total=retries,
         read=retries,
         connect=retries,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
+        limiter=limiter,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retry)
     session.mount("https://", adapter)
+    session.headers.update({"User-Agent": "Marinus/crt_sh", "Connection": "keep-alive"})
+
+    # Advertise every compression scheme that urllib3 can decode (brotli requires the brotli package)
+    session.headers.update(make_headers(accept_encoding=True))
     return session
 
 
-def make_https_request(logger, url, jobs_manager, download=False):
+# Pace out requests so as not to DoS crt.sh.
+# The zone queries are far more expensive for crt.sh so they have their own, slower, limit.
+CRT_SH_LIMITER = RateLimiter(CRT_SH_REQUESTS_PER_SECOND)
+CRT_SH_ZONE_LIMITER = RateLimiter(CRT_SH_ZONE_REQUESTS_PER_SECOND)
+
+# A single session is shared by every certificate request so that the TCP connection
+# and TLS handshake are reused rather than renegotiated for each certificate.
+# Each session applies its limiter to the retries as well as the first attempt.
+SESSION = requests_retry_session(limiter=CRT_SH_LIMITER)
+ZONE_SESSION = requests_retry_session(limiter=CRT_SH_ZONE_LIMITER)
+
+
+def make_https_request(
+    logger, url, download=False, session=SESSION, limiter=CRT_SH_LIMITER
+):
     """
     Utility function for making HTTPS requests.
+    The session and limiter default to those used for downloading certificates.
+    Returns None if the request failed so that the caller can record the failure.
     """
+    limiter.acquire()
+
     try:
-        req = requests_retry_session().get(url, timeout=120)
+        req = session.get(url, timeout=(5, 120))
     except Exception as ex:
-        logger.error("Connection died after 5 tries")
+        # Return to the caller so that the work completed so far is preserved
+        logger.error("Connection died after 5 tries: " + url)
         logger.error(str(ex))
-        jobs_manager.record_job_error()
-        exit(1)
+        return None
 
     if req.status_code != 200:
         return None
@@ -83,13 +214,30 @@ def make_https_request(logger, url, jobs_manager, download=False):
     return req.text
 
 
-def get_tracked_zone(name, zones):
+def get_matching_zones(name, zone_set):
+    """
+    Which tracked zones does the provided hostname belong to?
+    Each parent domain of the hostname is checked against the set of zones
+    so the cost depends on the number of labels rather than the number of zones.
+    The matches are returned from the most specific to the least specific.
+    """
+    matches = []
+    labels = name.split(".")
+    for i in range(len(labels)):
+        candidate = ".".join(labels[i:])
+        if candidate in zone_set:
+            matches.append(candidate)
+
+    return matches
+
+
+def get_tracked_zone(name, zone_set):
     """
     What is the tracked zone for the provided hostname?
     """
-    for zone in zones:
-        if name.endswith("." + zone) or name == zone:
-            return zone
+    matches = get_matching_zones(name, zone_set)
+    if len(matches) > 0:
+        return matches[0]
 
     return None
 
@@ -101,13 +249,26 @@ def add_new_domain_names(hostnames, zones, mongo_connector):
     """
     google_dns = GoogleDNS.GoogleDNS()
     dns_manager = DNSManager.DNSManager(mongo_connector)
+    zone_set = set(zones)
 
-    for hostname in hostnames:
-        results = google_dns.fetch_DNS_records(hostname)
+    # Database writes are accumulated and sent in batches
+    new_records = []
+
+    # The lookups run in worker threads while the database writes remain in this thread
+    with ThreadPoolExecutor(max_workers=DNS_LOOKUP_WORKERS) as executor:
+        futures = [
+            executor.submit(google_dns.fetch_DNS_records, hostname)
+            for hostname in hostnames
+        ]
+
+        for future in as_completed(futures):
+            results = future.result()
+
+            if results == []:
+                continue
 
-        if results != []:
             for result in results:
-                temp_zone = get_tracked_zone(result["fqdn"], zones)
+                temp_zone = get_tracked_zone(result["fqdn"], zone_set)
                 if temp_zone is not None:
                     new_record = {"fqdn": result["fqdn"]}
                     new_record["zone"] = temp_zone
@@ -115,27 +276,47 @@ def add_new_domain_names(hostnames, zones, mongo_connector):
                     new_record["type"] = result["type"]
                     new_record["value"] = result["value"]
                     new_record["status"] = "unknown"
-                    dns_manager.insert_record(new_record, "ssl")
+                    new_records.append(new_record)
+
+            if len(new_records) >= DNS_BATCH_SIZE:
+                dns_manager.bulk_upsert(new_records, "ssl")
+                new_records = []
+
+    dns_manager.bulk_upsert(new_records, "ssl")
+
+
+def get_distinct_values(ct_collection, field, query=None):
+    """
+    Return the set of distinct values for the field.
+    A distinct result is limited to the 16MB document size so larger result sets
+    fall back to a $group aggregation that is read back as a cursor.
+    """
+    if query is None:
+        query = {}
+
+    try:
+        return set(ct_collection.distinct(field, query))
+    except OperationFailure:
+        match = dict(query)
+        match.setdefault(field, {"$exists": True})
+        results = ct_collection.aggregate(
+            [{"$match": match}, {"$group": {"_id": "$" + field}}], allowDiskUse=True
+        )
+        return {result["_id"] for result in results}
 
 
 def get_list_of_existing_certificates(ct_collection):
     """
     We don't want to re-download data that we already have.
-    Therefore, we get the list of known crt_sh_ids from the database.
+    Therefore, we get the set of known crt_sh_ids from the database.
+    The $exists filter allows the sparse crt_sh_min_id index to be used.
     """
-    existing_ids = []
-    results = ct_collection.find(
-        {"crt_sh_min_id": {"$exists": True}}, {"crt_sh_min_id": 1}
+    return get_distinct_values(
+        ct_collection, "crt_sh_min_id", {"crt_sh_min_id": {"$exists": True}}
     )
 
-    for result in results:
-        if result["crt_sh_min_id"] not in existing_ids:
-            existing_ids.append(result["crt_sh_min_id"])
-
-    return existing_ids
-
 
-def get_cert_zones(cert, zones):
+def get_cert_zones(cert, zone_set):
     """
     Find the relevant certificate zones
     """
@@ -143,24 +324,201 @@ def get_cert_zones(cert, zones):
 
     if "subject_common_names" in cert:
         for cn in cert["subject_common_names"]:
-            for zone in zones:
-                if cn == zone or cn.endswith("." + zone):
-                    if zone not in cert_zones:
-                        cert_zones.append(zone)
+            for zone in get_matching_zones(cn, zone_set):
+                if zone not in cert_zones:
+                    cert_zones.append(zone)
 
     if "subject_dns_names" in cert:
         for cn in cert["subject_dns_names"]:
-            for zone in zones:
-                if cn == zone or cn.endswith("." + zone):
-                    if zone not in cert_zones:
-                        cert_zones.append(zone)
+            for zone in get_matching_zones(cn, zone_set):
+                if zone not in cert_zones:
+                    cert_zones.append(zone)
 
     return cert_zones
 
 
+def flush_operations(logger, ct_collection, operations):
+    """
+    Send the accumulated write operations to the database as a single unordered bulk write.
+    The list is cleared once the operations have been sent.
+    """
+    if len(operations) == 0:
+        return
+
+    try:
+        ct_collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as err:
+        logger.error(
+            "ERROR: "
+            + str(len(err.details["writeErrors"]))
+            + " certificates could not be written to the database"
+        )
+
+    operations.clear()
+
+
+def get_cert_shard(min_cert_id):
+    """
+    Return the two level subfolder that a certificate is saved under.
+    Spreading the files across subfolders keeps any one directory from growing
+    to millions of entries.
+    """
+    return "{:02x}/{:02x}".format(min_cert_id % 256, (min_cert_id // 256) % 256)
+
+
+def get_cert_file_name(min_cert_id):
+    """
+    Return the name of the saved certificate file relative to the save location.
+    """
+    return get_cert_shard(min_cert_id) + "/" + str(min_cert_id) + ".crt"
+
+
+def _fetch_certificate(
+    logger, x509_parser, min_cert_id, storage_manager, save_location
+):
+    """
+    Download, save, and fingerprint a single certificate from crt.sh.
+    This runs in a worker thread and must not touch the database.
+    The save_location is only provided for the local filesystem since the boto3 and
+    Azure clients are shared by the storage manager and are not thread-safe.
+    Returns a tuple of (min_cert_id, c_file, fingerprint) where c_file is None if
+    the download failed and the fingerprint is None if it could not be calculated.
+    """
+    c_file = make_https_request(logger, "https://crt.sh/?d=" + str(min_cert_id), True)
+
+    if c_file is None:
+        return (min_cert_id, None, None)
+
+    if save_location is not None:
+        storage_manager.write_file(
+            save_location, get_cert_file_name(min_cert_id), c_file
+        )
+
+    return (min_cert_id, c_file, x509_parser.get_fingerprint_sha256(c_file))
+
+
+def _record_certificates(
+    logger, x509_parser, downloaded, zone_set, ct_collection, operations
+):
+    """
+    Queue the database writes for a batch of downloaded certificates and flush them.
+    A single indexed query finds the certificates that are already in the database.
+    Those only need the crt.sh ID attached and are not parsed.
+    The list of downloaded certificates is cleared once they have been recorded.
+    """
+    fingerprints = [
+        fingerprint for _, _, fingerprint in downloaded if fingerprint is not None
+    ]
+    results = ct_collection.find(
+        {"fingerprint_sha256": {"$in": fingerprints}}, {"fingerprint_sha256": 1}
+    )
+    existing_fingerprints = {result["fingerprint_sha256"] for result in results}
+
+    for min_cert_id, c_file, fingerprint in downloaded:
+        if fingerprint in existing_fingerprints:
+            # The certificate exists in the database but does not have a crt_sh id
+            logger.info(
+                "Updating crt.sh id: " + str(min_cert_id) + " SHA256: " + fingerprint
+            )
+            operations.append(
+                UpdateOne(
+                    {"fingerprint_sha256": fingerprint},
+                    {
+                        "$set": {
+                            "crt_sh_min_id": min_cert_id,
+                            "marinus_updated": datetime.now(),
+                        },
+                        "$addToSet": {"sources": "crt_sh"},
+                    },
+                )
+            )
+            continue
+
+        cert = x509_parser.parse_data(c_file, "crt_sh")
+        if cert is None:
+            logger.warning(
+                "ERROR: Could not parse certificate for: "
+                + str(min_cert_id)
+                + ". Skipping for now."
+            )
+            continue
+
+        cert_zones = get_cert_zones(cert, zone_set)
+        logger.info(
+            "Adding crt.sh id: "
+            + str(min_cert_id)
+            + " SHA256: "
+            + cert["fingerprint_sha256"]
+        )
+
+        # A single upsert either updates the certificate that another source already
+        # recorded or inserts the newly parsed certificate.
+        operations.append(
+            UpdateOne(
+                {"fingerprint_sha256": cert["fingerprint_sha256"]},
+                {
+                    "$set": {
+                        "crt_sh_min_id": min_cert_id,
+                        "zones": cert_zones,
+                        "marinus_updated": datetime.now(),
+                    },
+                    "$addToSet": {"sources": "crt_sh"},
+                    "$setOnInsert": {
+                        key: value
+                        for key, value in cert.items()
+                        if key not in UPSERT_EXCLUDED_FIELDS
+                    },
+                },
+                upsert=True,
+            )
+        )
+
+    downloaded.clear()
+    flush_operations(logger, ct_collection, operations)
+
+
+def _collect_certificate_result(
+    logger,
+    result,
+    storage_manager,
+    save_location,
+    x509_parser,
+    downloaded,
+    failed_ids,
+    zone_set,
+    ct_collection,
+    operations,
+):
+    """
+    Add a completed download to the current batch and record the batch when it is full.
+    The certificate is saved here if a save_location is provided because the
+    storage backend could not be written to from the worker thread.
+    """
+    min_cert_id, c_file, fingerprint = result
+
+    if c_file is None:
+        logger.warning(
+            "ERROR: Failed communicating with crt.sh. Skipping cert_id: "
+            + str(min_cert_id)
+        )
+        failed_ids.append(min_cert_id)
+        return
+
+    if save_location is not None:
+        storage_manager.write_file(
+            save_location, get_cert_file_name(min_cert_id), c_file
+        )
+
+    downloaded.append(result)
+
+    if len(downloaded) >= MONGO_BATCH_SIZE:
+        _record_certificates(
+            logger, x509_parser, downloaded, zone_set, ct_collection, operations
+        )
+
+
 def add_new_certificate_values(
     logger,
-    jobs_manager,
     new_ids,
     ct_collection,
     zones,
@@ -169,72 +527,167 @@ def add_new_certificate_values(
 ):
     """
     Add new certificate values to the database.
+    The caller is expected to remove any IDs that are already in the database.
+    The downloads are performed by a pool of worker threads while the parsing and
+    database writes remain in the main thread. Files on the local filesystem are
+    saved by the workers while the S3 and Azure writes remain in the main thread.
+    Results are collected as they complete so that at most CRT_SH_WORKERS downloads
+    are outstanding at once.
+    Returns the number of certificates that could not be downloaded.
     """
+    if len(new_ids) == 0:
+        return 0
+
     x509_parser = X509Parser.X509Parser()
+    zone_set = set(zones)
+
+    # Downloaded certificates and database writes are accumulated and sent in batches
+    downloaded = []
+    operations = []
+
+    # The certificate subfolders that have already been created on the local filesystem
+    created_shards = set()
+
+    # Only local filesystem writes are safe to perform from the worker threads
+    worker_save_location = None
+    main_save_location = save_location
+    if (
+        save_location is not None
+        and storage_manager.storage_location
+        == StorageManager.StorageManager.LOCAL_FILESYSTEM
+    ):
+        worker_save_location = save_location
+        main_save_location = None
+
+    # Pending downloads and writes are recorded even if the run is interrupted.
+    # Failed IDs are not recorded so they will be requested again by the next run.
+    # A future is only removed from pending once its result has been collected.
+    failed_ids = []
+    pending = set()
+    try:
+        with ThreadPoolExecutor(max_workers=CRT_SH_WORKERS) as executor:
+            for min_cert_id in new_ids:
+                # Local subfolders are created up front so the workers don't race to create them
+                if worker_save_location is not None:
+                    shard = get_cert_shard(min_cert_id)
+                    if shard not in created_shards:
+                        storage_manager.create_folder(save_location + shard)
+                        created_shards.add(shard)
+
+                # Collect finished downloads before submitting more work
+                if len(pending) >= CRT_SH_WORKERS:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _collect_certificate_result(
+                            logger,
+                            future.result(),
+                            storage_manager,
+                            main_save_location,
+                            x509_parser,
+                            downloaded,
+                            failed_ids,
+                            zone_set,
+                            ct_collection,
+                            operations,
+                        )
+                        pending.discard(future)
+
+                pending.add(
+                    executor.submit(
+                        _fetch_certificate,
+                        logger,
+                        x509_parser,
+                        min_cert_id,
+                        storage_manager,
+                        worker_save_location,
+                    )
+                )
+
+            for future in as_completed(list(pending)):
+                _collect_certificate_result(
+                    logger,
+                    future.result(),
+                    storage_manager,
+                    main_save_location,
+                    x509_parser,
+                    downloaded,
+                    failed_ids,
+                    zone_set,
+                    ct_collection,
+                    operations,
+                )
+                pending.discard(future)
+    finally:
+        # The executor waits for running downloads when the run is interrupted.
+        # Those certificates have already been saved so their results are recorded too.
+        for future in pending:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                _collect_certificate_result(
+                    logger,
+                    future.result(),
+                    storage_manager,
+                    main_save_location,
+                    x509_parser,
+                    downloaded,
+                    failed_ids,
+                    zone_set,
+                    ct_collection,
+                    operations,
+                )
+        if len(downloaded) > 0:
+            _record_certificates(
+                logger, x509_parser, downloaded, zone_set, ct_collection, operations
+            )
+        flush_operations(logger, ct_collection, operations)
 
-    existing_ids = get_list_of_existing_certificates(ct_collection)
+    if len(failed_ids) > 0:
+        logger.warning(
+            "Could not download "
+            + str(len(failed_ids))
+            + " certificates from crt.sh. They will be retried on the next run."
+        )
 
-    for min_cert_id in new_ids:
-        if min_cert_id not in existing_ids:
-            # Pace out certificate requests against their service
-            time.sleep(2)
+    return len(failed_ids)
 
-            c_file = make_https_request(
-                logger, "https://crt.sh/?d=" + str(min_cert_id), jobs_manager, True
-            )
 
-            if c_file is None:
-                logger.warning(
-                    "ERROR: Failed communicating with crt.sh. Skipping cert_id: "
-                    + str(min_cert_id)
-                )
-                continue
+def _fetch_zone(logger, zone):
+    """
+    Query crt.sh for all certificates matching the provided zone.
+    This runs in a worker thread and returns a tuple of (zone, json_data).
+    The json_data is None if the query failed.
+    """
+    # This could be done with backoff but we don't want to be overly aggressive.
+    # The raw bytes are requested since the JSON parser does not need a decoded string.
+    json_result = make_https_request(
+        logger,
+        "https://crt.sh/?q=%25." + zone + "&output=json",
+        True,
+        ZONE_SESSION,
+        CRT_SH_ZONE_LIMITER,
+    )
+    if json_result is None:
+        logger.warning("Can't find result for: " + zone)
+        return (zone, None)
 
-            if save_location is not None:
-                storage_manager.write_file(
-                    save_location, str(min_cert_id) + ".crt", c_file
-                )
+    # crt.sh can return an HTML error page or a truncated body with a 200 status
+    try:
+        return (zone, json_loads(json_result))
+    except ValueError as ex:
+        logger.warning("Could not parse the crt.sh result for: " + zone)
+        logger.warning(str(ex))
+        return (zone, None)
 
-            cert = x509_parser.parse_data(c_file, "crt_sh")
-            if cert is None:
-                logger.warning(
-                    "ERROR: Could not parse certificate for: "
-                    + str(min_cert_id)
-                    + ". Skipping for now."
-                )
-                continue
 
-            cert_zones = get_cert_zones(cert, zones)
-            logger.info(
-                "Adding crt.sh id: "
-                + str(min_cert_id)
-                + " SHA256: "
-                + cert["fingerprint_sha256"]
-            )
+def fetch_zone_results(logger, zones):
+    """
+    Query crt.sh for each zone using a small pool of worker threads.
+    The results are yielded as (zone, json_data) tuples as each query completes.
+    """
+    with ThreadPoolExecutor(max_workers=CRT_SH_ZONE_WORKERS) as executor:
+        futures = [executor.submit(_fetch_zone, logger, zone) for zone in zones]
 
-            if (
-                ct_collection.count_documents(
-                    {"fingerprint_sha256": cert["fingerprint_sha256"]}
-                )
-                != 0
-            ):
-                # The certificate exists in the database but does not have crt_sh id and/or zones
-                ct_collection.update_one(
-                    {"fingerprint_sha256": cert["fingerprint_sha256"]},
-                    {
-                        "$set": {
-                            "crt_sh_min_id": min_cert_id,
-                            "zones": cert_zones,
-                            "marinus_updated": datetime.now(),
-                        },
-                        "$addToSet": {"sources": "crt_sh"},
-                    },
-                )
-            else:
-                # Add the new certificate
-                cert["crt_sh_min_id"] = min_cert_id
-                cert["zones"] = cert_zones
-                ct_collection.insert_one(cert)
+        for future in as_completed(futures):
+            yield future.result()
 
 
 def check_save_location(storage_manager, save_location):
@@ -252,6 +705,9 @@ def main(logger=None):
     if logger is None:
         logger = LoggingUtil.create_log(__name__)
 
+    atexit.register(SESSION.close)
+    atexit.register(ZONE_SESSION.close)
+
     now = datetime.now()
     print("Starting: " + str(now))
     logger.info("Starting...")
@@ -313,46 +769,53 @@ def main(logger=None):
     if args.download_methods == "dbAndSave":
         check_save_location(storage_manager, save_location)
 
-    for zone in zones:
-        # Pace out requests so as not to DoS crt.sh and Google DNS
-        time.sleep(10)
+    # Collect the IDs and names across every zone so that each certificate and
+    # hostname is only processed once, even when it appears under several zones.
+    new_names = set()
+    new_ids = set()
+    failed_zones = []
+    for zone, json_data in fetch_zone_results(logger, zones):
+        if json_data is None:
+            failed_zones.append(zone)
+            continue
 
-        # This could be done with backoff but we don't want to be overly aggressive.
-        json_result = make_https_request(
-            logger, "https://crt.sh/?q=%25." + zone + "&output=json", jobs_manager
-        )
-        if json_result is None:
-            logger.warning("Can't find result for: " + zone)
-            json_result = "{}"
+        for entry in json_data:
+            new_ids.add(entry["id"])
 
-        json_data = json.loads(json_result)
+            # A single entry can list several newline separated names
+            for name_value in entry["name_value"].splitlines():
+                if "*" not in name_value:
+                    new_names.add(name_value)
 
-        new_names = []
-        new_ids = []
-        for entry in json_data:
-            if entry["id"] not in new_ids:
-                new_ids.append(entry["id"])
-
-            if "*" not in entry["name_value"] and entry["name_value"] not in new_names:
-                new_names.append(entry["name_value"])
-
-        if args.fetch_dns_records:
-            add_new_domain_names(new_names, zones, mongo_connector)
-
-        if args.download_methods == "dbAndSave":
-            add_new_certificate_values(
-                logger,
-                jobs_manager,
-                new_ids,
-                ct_collection,
-                zones,
-                storage_manager,
-                save_location,
-            )
-        elif args.download_methods == "dbOnly":
-            add_new_certificate_values(
-                logger, jobs_manager, new_ids, ct_collection, zones, None, None
-            )
+    if args.fetch_dns_records:
+        add_new_domain_names(new_names, zones, mongo_connector)
+
+    # We don't want to re-download certificates that we already have.
+    # The remaining IDs are sorted so that the database writes arrive in ascending order.
+    new_ids = sorted(new_ids - get_list_of_existing_certificates(ct_collection))
+    logger.info("Found " + str(len(new_ids)) + " new crt.sh certificate ids")
+
+    # Raise SystemExit on SIGTERM while downloading certificates so that pending
+    # database writes are flushed. The zone and DNS phases have nothing to flush
+    # and keep the default handler so that they end immediately.
+    previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: exit(1))
+
+    failed_certs = 0
+    if args.download_methods == "dbAndSave":
+        failed_certs = add_new_certificate_values(
+            logger,
+            new_ids,
+            ct_collection,
+            zones,
+            storage_manager,
+            save_location,
+        )
+    elif args.download_methods == "dbOnly":
+        failed_certs = add_new_certificate_values(
+            logger, new_ids, ct_collection, zones, None, None
+        )
+
+    signal.signal(signal.SIGTERM, previous_handler)
 
     # Set isExpired for any entries that have recently expired.
     ct_collection.update_many(
@@ -360,7 +823,24 @@ def main(logger=None):
         {"$set": {"isExpired": True}},
     )
 
-    jobs_manager.record_job_complete()
+    if failed_certs > 0:
+        logger.warning(
+            str(failed_certs) + " certificate downloads failed during this run"
+        )
+
+    # The certificates from failed zones are missing entirely so the run is an error
+    if len(failed_zones) > 0:
+        logger.error(
+            "ERROR: "
+            + str(len(failed_zones))
+            + " of "
+            + str(len(zones))
+            + " crt.sh zone queries failed: "
+            + ", ".join(failed_zones)
+        )
+        jobs_manager.record_job_error()
+    else:
+        jobs_manager.record_job_complete()
 
     now = datetime.now()
     print("Ending: " + str(now))
@@ -18,6 +18,7 @@ import logging
 from datetime import datetime
 
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
 
 from libs3 import IPManager, MongoConnector
 
@@ -144,6 +145,62 @@ class DNSManager(object):
             ip_manager = IPManager.IPManager(self.mongo_connector)
             ip_manager.insert_record(result["value"], source_name)
 
+    def bulk_upsert(self, results, source_name):
+        """
+        Insert or update the provided records from the provided source name using a single bulk write.
+        This has the same effect as calling insert_record for each record.
+        Each record expands into three ordered operations. The first creates the record if it is missing.
+        The second refreshes the source if it is already attached. The third attaches a missing source.
+        :param results: A list of DNS lookup results as JSON objects including
+                        the fqdn, type, value, zone, and created values.
+        :param source_name: The DNS record source ("ssl","virustotal","sonar_dns","common_crawl")
+        """
+        if len(results) == 0:
+            return
+
+        now = datetime.now()
+        operations = []
+        for result in results:
+            query = {
+                "fqdn": result["fqdn"],
+                "type": result["type"],
+                "value": result["value"],
+            }
+
+            new_record = {
+                key: value
+                for key, value in result.items()
+                if key not in query and key not in ["sources", "updated"]
+            }
+            new_record["sources"] = []
+
+            operations.append(
+                UpdateOne(
+                    query,
+                    {"$set": {"updated": now}, "$setOnInsert": new_record},
+                    upsert=True,
+                )
+            )
+            operations.append(
+                UpdateOne(
+                    dict(query, **{"sources.source": source_name}),
+                    {"$set": {"sources.$.updated": now}},
+                )
+            )
+            operations.append(
+                UpdateOne(
+                    dict(query, **{"sources.source": {"$ne": source_name}}),
+                    {"$push": {"sources": {"source": source_name, "updated": now}}},
+                )
+            )
+
+        self.all_dns_collection.bulk_write(operations, ordered=True)
+
+        ip_manager = IPManager.IPManager(self.mongo_connector)
+        for result in results:
+            if result["type"] == "a" or result["type"] == "aaaa":
+                ip_manager.insert_record(result["value"], source_name)
+
     def find_multiple(self, criteria, source):
         """
         Find multiple records for the specified criteria.
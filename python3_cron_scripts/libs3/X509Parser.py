@@ -22,7 +22,9 @@ with "pyOpenSSL". Therefore, "cryptography" is used except in those places where
 
 import base64
 import binascii
+import hashlib
 import logging
+import ssl
 import struct
 import sys
 from datetime import datetime
@@ -30,7 +32,6 @@ from datetime import datetime
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.bindings.openssl import binding
-from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.x509 import ExtensionNotFound
 from cryptography.x509.oid import (
@@ -626,12 +627,11 @@ class X509Parser(object):
         used with the Google certificate transparency libraries.
         """
         cert_object = {}
-        cert_object["fingerprint_sha1"] = binascii.hexlify(
-            cert.fingerprint(hashes.SHA1())
-        ).decode("utf-8")
-        cert_object["fingerprint_sha256"] = binascii.hexlify(
-            cert.fingerprint(hashes.SHA256())
-        ).decode("utf-8")
+
+        # hashlib calls straight into OpenSSL's digests rather than through the cryptography wrappers
+        der_data = cert.public_bytes(Encoding.DER)
+        cert_object["fingerprint_sha1"] = hashlib.sha1(der_data).hexdigest()
+        cert_object["fingerprint_sha256"] = hashlib.sha256(der_data).hexdigest()
 
         try:
             cert_object["not_before"] = cert.not_valid_before
@@ -765,6 +765,21 @@ class X509Parser(object):
 
         return cert_object
 
+    def get_fingerprint_sha256(self, cert_data):
+        """
+        Calculate the SHA256 fingerprint of the provided PEM or DER encoded bytes without parsing the certificate.
+        The value matches the fingerprint_sha256 field that is created by the parser.
+        Returns None if the PEM data could not be decoded.
+        """
+        if cert_data.lstrip().startswith(b"-----BEGIN"):
+            try:
+                cert_data = ssl.PEM_cert_to_DER_cert(cert_data.decode("ascii").strip())
+            except (UnicodeDecodeError, ValueError, binascii.Error):
+                self._logger.debug("WARNING: Could not decode the PEM certificate")
+                return None
+
+        return hashlib.sha256(cert_data).hexdigest()
+
     def parse_file(self, file_name, certSource):
         """
         Parse the filename that is provided from the given certificate source
@@ -76,6 +76,19 @@ def create_collections(m_connection):
             print("WARNING: The " + collection + " already exists.")
 
 
+def create_indexes(m_connection):
+    """
+    Create the indexes that the cron scripts rely upon for their lookups.
+    MongoDB will not recreate an index that already exists.
+    """
+    ct_collection = m_connection["ct_certs"]
+
+    print("Creating indexes for the ct_certs collection")
+    ct_collection.create_index("crt_sh_min_id", sparse=True)
+    ct_collection.create_index("fingerprint_sha256")
+    ct_collection.create_index([("isExpired", 1), ("not_after", 1)])
+
+
 def create_job_collection(mongo_connector):
     """
     For people who want to run every possible script, this will pre-populate the collection with all of the currently known scripts.
@@ -539,6 +552,7 @@ def main():
 
     if args.create_collections:
         create_collections(mongo_connector.m_connection)
+        create_indexes(mongo_connector.m_connection)
         create_job_collection(mongo_connector)
         create_config_collection(mongo_connector)
         create_user(mongo_connector, "marinus")